@@ -1,19 +1,132 @@
 import time
 from datetime import timedelta
+from collections import defaultdict
 import logging
+import threading
+import Queue
 
 import pymongo
+from bson import BSON
+from bson.son import SON
+from pymongo.errors import AutoReconnect, BulkWriteError
 from pymongo.errors import DuplicateKeyError, OperationFailure
 
 from oplogwatcher import OplogWatcher
 
+logger = logging.getLogger(__name__)
+
+class _ReplayState(threading.local):
+    """ Replay state that belongs to the thread replaying the ops (see
+    OplogReplayer.process_op).
+    """
+
+    def __init__(self):
+        # Inserts waiting to be written to destination, keyed by ns.
+        self.pending = defaultdict(list)
+        self.pending_bytes = defaultdict(int)
+        # The _ids of those inserts, see OplogReplayer.insert.
+        self.pending_ids = defaultdict(set)
+
+class _ReplayWorker(threading.Thread):
+    """ Replays the ops of a subset of namespaces, on behalf of an
+    OplogReplayer (see OplogReplayer.process_op).
+    """
+
+    def __init__(self, replayer, maxsize):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.replayer = replayer
+        self.queue = Queue.Queue(maxsize=maxsize)
+        # Last error the worker gave up on: either a retried error, after
+        # being stopped, or any other error. Raised by the replayer at the
+        # next flush.
+        self.error = None
+
+    def put(self, ns, raw):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((ns, raw))
+
+    def flush(self):
+        """ Asks the worker to write out its buffered ops.
+
+        Returns a threading.Event, which is set once done.
+        """
+        done = threading.Event()
+        self.queue.put((None, done))
+        return done
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        replayer = self.replayer
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            ns, arg = item
+            # After an error, keep draining the queue without replaying
+            # anything, so that the replayer never blocks on this worker.
+            if self.error is None:
+                try:
+                    if ns is None:
+                        self._retry(replayer._flush_local)
+                    else:
+                        self._retry(replayer._handlers[arg['op']], ns, arg)
+                except Exception, e:
+                    logger.exception(e)
+                    self.error = e
+            if ns is None:
+                arg.set()
+
+    def _retry(self, func, *args):
+        """ Calls func until it succeeds, or until the replayer is stopped. """
+        while True:
+            try:
+                func(*args)
+                return
+            except (AutoReconnect, OperationFailure), e:
+                logger.warning(e)
+                if not self.replayer.running:
+                    self.error = e
+                    return
+                self.replayer._pause()
+
 class OplogReplayer(OplogWatcher):
     """ Replays all oplogs from one mongo connection to another.
 
     Watches a mongo connection for write ops (source), and replays them
     into another mongo connection (destination).
+
+    Consecutive inserts into the same namespace are buffered and written
+    to destination in a single batch, see flush().
+
+    With workers > 1, inserts, updates and deletes are replayed in parallel
+    by that many threads. Ops on different namespaces commute, so each
+    namespace is assigned to a single worker, which preserves its op order.
+    Commands and index operations wait for all workers to catch up, and are
+    replayed by the calling thread.
     """
 
+    # Flush a namespace's buffered inserts once it holds this many documents
+    # or this many (BSON-encoded) bytes, whichever comes first.
+    insert_batch_size = 1000
+    insert_batch_bytes = 8 * 1024 * 1024
+
+    # Besides whenever there are no new ops (see flush), record the lastts
+    # on destination every this many replayed ops. That writes out all
+    # buffered inserts and waits for all workers, so keep it well above
+    # insert_batch_size.
+    lastts_update_ops = 10 * insert_batch_size
+
+    # Commands found in the oplog. Their name has to be the first key of the
+    # command document, which dicts don't preserve (see command).
+    oplog_commands = ('create', 'drop', 'dropDatabase', 'renameCollection',
+                      'collMod', 'convertToCapped', 'emptycapped',
+                      'createIndexes', 'dropIndexes', 'applyOps')
+
     @staticmethod
     def is_create_index(raw):
         """ Determines if the given operation is a "create index"" operation.
@@ -36,48 +149,105 @@ class OplogReplayer(OplogWatcher):
 
     @staticmethod
     def is_index_operation(raw):
-        return (OplogReplayer.is_create_index(raw) or
-                OplogReplayer.is_drop_index(raw))
+        # Check raw['op'] first: most ops are neither inserts nor commands.
+        op = raw['op']
+        if op == 'i':
+            return raw['ns'].endswith('.system.indexes')
+        elif op == 'c':
+            return 'dropIndexes' in raw['o']
+        return False
 
     def __init__(self, source, dest, replay_indexes=True, ts=None,
-                 poll_time=1.0):
+                 poll_time=1.0, workers=1, databases=None):
         # Create a one-time connection to source, to determine replicaset.
-        c = pymongo.Connection(source)
+        c = pymongo.MongoClient(source)
         try:
             obj = c.local.system.replset.find_one()
             replicaset = obj['_id']
         except:
             raise ValueError('Could not determine replicaset for %r' % source)
-
-        # Mongo source is a replica set, connect to it as such.
-        self.source = pymongo.Connection(source, replicaset=replicaset)
-        # Use ReadPreference.SECONDARY because we can afford to read oplogs
-        # from secondaries: even if they're behind, everything will work
-        # correctly because the oplog order will always be preserved.
-        self.source.read_preference = pymongo.ReadPreference.SECONDARY
+        finally:
+            # Its monitor threads & sockets are of no use past this point.
+            c.close()
+
+        # Mongo source is a replica set, connect to it as such. Prefer
+        # reading from secondaries because we can afford to read oplogs from
+        # them: even if they're behind, everything will work correctly
+        # because the oplog order will always be preserved. Fall back to the
+        # primary when no secondary is available.
+        self.source = pymongo.MongoClient(
+            source, replicaset=replicaset,
+            read_preference=pymongo.ReadPreference.SECONDARY_PREFERRED)
 
         self._lastts_id = '%s-lastts' % replicaset
-        self.dest = pymongo.Connection(dest)
+        # Writes to destination are acknowledged (w=1).
+        self.dest = pymongo.MongoClient(dest, w=1)
 
         self.replay_indexes = replay_indexes
 
+        # Destination collections, keyed by ns (see _dest_coll).
+        self._dest_colls = {}
+
+        # Buffered inserts belong to the thread replaying their namespace.
+        self._state = _ReplayState()
+
+        # Whether self.ts moved past the lastts recorded on destination.
+        self._ts_dirty = False
+
         # When no ts argument is supplied, get the last timestamp from dest.
         if ts is None:
             ts = self._get_lastts()
 
         self._replay_count = 0
+        # Replay count at which to record the lastts next (see flush).
+        self._next_lastts_at = self.lastts_update_ops
+        # Replay counts at which to print replication info next.
+        self._next_debug_at = 500
+        self._next_info_at = 5000
         # Compute velocity every few ops.
         self._started_at = self._last_velocity_at = time.time()
         self._last_replay_count = 0
-        OplogWatcher.__init__(self, self.source, ts=ts, poll_time=poll_time)
+        OplogWatcher.__init__(self, self.source, ts=ts, poll_time=poll_time,
+                              databases=databases)
+
+        self._workers = []
+        if workers > 1:
+            self._workers = [_ReplayWorker(self, self.cursor_batch_size)
+                             for _ in xrange(workers)]
+
+    def start(self):
+        """ Starts the OplogReplayer, along with its workers.
+
+        Closes the connections to source and destination once done, so an
+        OplogReplayer can only be started once.
+        """
+        for worker in self._workers:
+            worker.start()
+        try:
+            OplogWatcher.start(self)
+        finally:
+            for worker in self._workers:
+                worker.stop()
+            for worker in self._workers:
+                worker.join()
+            self.source.close()
+            self.dest.close()
 
     def print_replication_info(self):
-        # Only print replication info every few hundred replayed ops.
-        if self._replay_count % 5000 == 0:
-            lprint = logging.info
-        elif self._replay_count % 500 == 0:
-            lprint = logging.debug
+        # Only print replication info every few hundred replayed ops. This
+        # is called for every op, so bail out with a single comparison.
+        if self._replay_count < self._next_debug_at:
+            return
+        self._next_debug_at += 500
+
+        if self._replay_count >= self._next_info_at:
+            self._next_info_at += 5000
+            level = logging.INFO
         else:
+            level = logging.DEBUG
+
+        # Don't bother formatting messages that won't be logged anyway.
+        if not logger.isEnabledFor(level):
             return
 
         # Avoid multiple time.time() syscalls.
@@ -85,18 +255,20 @@ class OplogReplayer(OplogWatcher):
 
         # Print sync status.
         delay = now - self.ts.time
-        lprint('synced = %dsecs ago (%.2fhrs)' % (delay, delay/3600.0))
+        logger.log(level, 'synced = %dsecs ago (%.2fhrs)' %
+                   (delay, delay/3600.0))
 
         # Print current velocity (ops per second).
         new_ops_since_last_print = self._replay_count - self._last_replay_count
         velocity = new_ops_since_last_print / (now - self._last_velocity_at)
         self._last_replay_count = self._replay_count
         self._last_velocity_at = now
-        lprint('current replay speed: %.2fops/sec' % velocity)
+        logger.log(level, 'current replay speed: %.2fops/sec' % velocity)
 
         # Print total number of oplogs replayed.
         tdiff = timedelta(seconds=int(now - self._started_at))
-        lprint('replayed %s ops in %s' % (self._replay_count, tdiff))
+        logger.log(level, 'replayed %s ops in %s' %
+                   (self._replay_count, tdiff))
 
     def _get_lastts(self):
         # Get the last oplog ts that was played on destination.
@@ -107,32 +279,125 @@ class OplogReplayer(OplogWatcher):
             return obj['value']
 
     def _update_lastts(self):
-        self.dest.oplogreplay.settings.update({'_id': self._lastts_id},
-                                              {'$set': {'value': self.ts}},
-                                              upsert=True)
+        self.dest.oplogreplay.settings.update_one({'_id': self._lastts_id},
+                                                  {'$set': {'value': self.ts}},
+                                                  upsert=True)
 
     def process_op(self, ns, raw):
-        if not self.replay_indexes and OplogReplayer.is_index_operation(raw):
+        op = raw['op']
+        if op == 'n':
+            # Nothing to replay, e.g.: periodic noops written by the primary.
+            # Don't even record lastts for these, the next real op will.
+            self.ts = raw['ts']
+            return
+
+        if self.databases is not None and not self._watches(ns, raw):
+            # Not replayed, but lastts can still move past it.
+            self.ts = raw['ts']
+            self._ts_dirty = True
+            return
+
+        # Same as is_drop_index & is_index_operation, inlined as this runs
+        # for every single op.
+        is_drop_index = op == 'c' and 'dropIndexes' in raw['o']
+        is_index_operation = is_drop_index or (
+            op == 'i' and ns.endswith('.system.indexes'))
+
+        must_serialize = op == 'c' or is_index_operation
+        if must_serialize:
+            # Commands and index operations might depend on buffered inserts
+            # (e.g.: dropping a collection), so write those out first.
+            self._flush_pending()
+
+        if not self.replay_indexes and is_index_operation:
             # Do not replay index operations.
-            pass
-        else:
+            self.ts = raw['ts']
+        elif is_drop_index:
             # Treat "drop index" operations separately.
-            if OplogReplayer.is_drop_index(raw):
-                self.drop_index(raw)
-            else:
-                OplogWatcher.process_op(self, ns, raw)
+            self.drop_index(raw)
+            self.ts = raw['ts']
+        elif self._workers and not must_serialize and op in ('i', 'u', 'd'):
+            worker = self._workers[hash(ns) % len(self._workers)]
+            worker.put(ns, raw)
+            self.ts = raw['ts']
+        else:
+            # Already filtered on databases above.
+            self._dispatch(ns, raw)
 
-        # Update the lastts on the destination
-        self._update_lastts()
+        self._ts_dirty = True
         self._replay_count += 1
+
+        # Update the lastts on the destination every few thousand ops.
+        # Commands and index operations are not idempotent, so record those
+        # right away.
+        if must_serialize or self._replay_count >= self._next_lastts_at:
+            self.flush()
+
         self.print_replication_info()
 
+    def flush(self):
+        """ Writes all buffered ops to destination & updates the lastts.
+
+        Called whenever there were no new ops for poll_time seconds, and
+        every lastts_update_ops replayed ops (see process_op).
+        """
+        self._flush_pending()
+        if self._ts_dirty:
+            self._update_lastts()
+            self._ts_dirty = False
+        self._next_lastts_at = self._replay_count + self.lastts_update_ops
+
+    def _flush_pending(self):
+        # Wait for all workers to replay their queued ops & write out their
+        # buffered inserts.
+        if self._workers:
+            for done in [worker.flush() for worker in self._workers]:
+                done.wait()
+            for worker in self._workers:
+                if worker.error is not None:
+                    raise worker.error
+
+        self._flush_local()
+
+    def _flush_local(self):
+        # Write out the inserts buffered by the current thread.
+        for ns in self._state.pending.keys():
+            self._flush_ns(ns)
+
+    def _flush_ns(self, ns):
+        state = self._state
+        docs = state.pending.get(ns)
+        if not docs:
+            return
+
+        # Unordered, so that a duplicate _id doesn't stop the rest of the
+        # batch from being inserted. insert_many splits the batch according
+        # to the server's limits.
+        try:
+            self._dest_coll(ns).insert_many(docs, ordered=False)
+        except BulkWriteError, e:
+            errors = e.details['writeErrors']
+            if (e.details['writeConcernErrors'] or
+                any(error['code'] != 11000 for error in errors)):
+                raise
+            logger.warning('%d duplicate key errors on %s' % (len(errors), ns))
+
+        # Only forget the docs once written, so that a failed flush (e.g.:
+        # AutoReconnect) is retried instead of losing them. Batches holding
+        # unhashable _ids might have no pending_ids (see insert).
+        del state.pending[ns]
+        del state.pending_bytes[ns]
+        state.pending_ids.pop(ns, None)
+
     def _dest_coll(self, ns):
-        db, collection = ns.split('.', 1)
-        return self.dest[db][collection]
+        coll = self._dest_colls.get(ns)
+        if coll is None:
+            db, collection = ns.split('.', 1)
+            coll = self._dest_colls[ns] = self.dest[db][collection]
+        return coll
 
     def insert(self, ns, docid, raw, **kw):
-        """ Perform a single insert operation.
+        """ Buffer a single insert operation (see flush).
 
             {'docid': ObjectId('4e95ae77a20e6164850761cd'),
              'ns': u'mydb.tweets',
@@ -144,10 +409,32 @@ class OplogReplayer(OplogWatcher):
                      u'op': u'i',
                      u'ts': Timestamp(1318432375, 1)}}
         """
+        if OplogReplayer.is_create_index(raw):
+            # Index creation can't be deferred, see process_op.
+            try:
+                self._dest_coll(ns).insert_one(raw['o'])
+            except DuplicateKeyError, e:
+                logger.warning(e)
+            return
+
+        # Batches are written unordered, so a batch should never hold the
+        # same _id twice: start a new one instead. Unhashable _ids can't be
+        # tracked, so they always start a new batch.
+        state = self._state
         try:
-            self._dest_coll(ns).insert(raw['o'], safe=True)
-        except DuplicateKeyError, e:
-            logging.warning(e)
+            if docid in state.pending_ids[ns]:
+                self._flush_ns(ns)
+            state.pending_ids[ns].add(docid)
+        except TypeError:
+            self._flush_ns(ns)
+
+        doc = raw['o']
+        docs = state.pending[ns]
+        docs.append(doc)
+        state.pending_bytes[ns] += len(BSON.encode(doc))
+        if (len(docs) >= self.insert_batch_size or
+            state.pending_bytes[ns] >= self.insert_batch_bytes):
+            self._flush_ns(ns)
 
     def update(self, ns, docid, raw, **kw):
         """ Perform a single update operation.
@@ -161,7 +448,15 @@ class OplogReplayer(OplogWatcher):
                      u'op': u'u',
                      u'ts': Timestamp(1318432339, 1)}}
         """
-        self._dest_coll(ns).update(raw['o2'], raw['o'], safe=True)
+        # Buffered inserts into ns must be written before updating.
+        self._flush_ns(ns)
+        # Oplog updates are either all update operators, or a replacement
+        # document.
+        o = raw['o']
+        if o and next(iter(o)).startswith('$'):
+            self._dest_coll(ns).update_one(raw['o2'], o)
+        else:
+            self._dest_coll(ns).replace_one(raw['o2'], o)
 
     def delete(self, ns, docid, raw, **kw):
         """ Perform a single delete operation.
@@ -175,7 +470,9 @@ class OplogReplayer(OplogWatcher):
                      u'op': u'd',
                      u'ts': Timestamp(1318432261, 10499)}}
         """
-        self._dest_coll(ns).remove(raw['o'], safe=True)
+        # Buffered inserts into ns must be written before deleting.
+        self._flush_ns(ns)
+        self._dest_coll(ns).delete_one(raw['o'])
 
     def drop_index(self, raw):
         """ Executes a drop index command.
@@ -185,9 +482,9 @@ class OplogReplayer(OplogWatcher):
               "o" : { "dropIndexes" : "testcoll",
             		  "index" : "nuie_1" } }
         """
-        dbname = raw['ns'].split('.', 1)[0]
         collname = raw['o']['dropIndexes']
-        self.dest[dbname][collname].drop_index(raw['o']['index'])
+        db = self._dest_coll(raw['ns']).database
+        db[collname].drop_index(raw['o']['index'])
 
     def command(self, ns, raw, **kw):
         """ Executes command.
@@ -197,9 +494,16 @@ class OplogReplayer(OplogWatcher):
               "o" : { "drop" : "fs.files"}
             }
         """
+        o = raw['o']
+        for name in self.oplog_commands:
+            if name in o:
+                o = SON([(name, o[name])] +
+                        [(k, v) for k, v in o.iteritems() if k != name])
+                break
+
         try:
-            dbname = raw['ns'].split('.', 1)[0]
-            self.dest[dbname].command(raw['o'], check=True)
+            db = self._dest_coll(raw['ns']).database
+            db.command(o, check=True)
         except OperationFailure, e:
-            logging.warning(e)
+            logger.warning(e)
 
@@ -1,7 +1,9 @@
-import time
+import sys
 import logging
+import threading
+import Queue
 
-import pymongo
+from pymongo.cursor import CursorType
 from pymongo.errors import AutoReconnect, OperationFailure, DuplicateKeyError
 from bson.timestamp import Timestamp
 
@@ -12,6 +14,9 @@ class OplogWatcher(object):
     entries, and calls process_op for each new entry.
     """
 
+    # Number of oplog entries to fetch from source with each getMore.
+    cursor_batch_size = 4096
+
     @staticmethod
     def __get_id(op):
         opid = None
@@ -24,16 +29,37 @@ class OplogWatcher(object):
 
         return opid
 
-    def __init__(self, connection, ts=None, poll_time=1.0):
+    def __init__(self, connection, ts=None, poll_time=1.0, databases=None):
         if ts is not None and not isinstance(ts, Timestamp):
             raise ValueError('ts argument: expected %r, got %r' % \
                              (Timestamp, type(ts)))
         self.poll_time = poll_time
         self.connection = connection
         self.ts = ts
+        # Only process ops on these databases (all, when None). A frozenset
+        # keeps the per-op membership test O(1), whatever was passed in.
+        if databases is not None:
+            databases = frozenset(databases)
+        self.databases = databases
+        # Whether ops on a given ns are processed, keyed by ns (see _watches).
+        self._watched_ns = {}
+
+        # Handlers used by process_op, keyed by raw['op'].
+        self._handlers = {
+            'i': self._do_insert,
+            'u': self._do_update,
+            'd': self._do_delete,
+            'c': self._do_command,
+            'db': self._do_db_declare,
+            'n': self._do_noop,
+        }
 
-        # Mark as running.
+        # Mark as running. stop() also sets _stopped, which wakes up any
+        # thread waiting before a retry (see _pause).
         self.running = True
+        self._stopped = threading.Event()
+        # Oplog entries fetched from source, waiting to be processed.
+        self._queue = None
 
     def start(self):
         """ Starts the OplogWatcher. """
@@ -53,30 +79,123 @@ class OplogWatcher(object):
         else:
             logging.info('Watching all oplogs')
 
-        while self.running:
-            query = { 'ts': {'$gt': self.ts} }
+        # Oplog entries are fetched by a separate thread, so that waiting for
+        # the next batch from source overlaps with processing the current one.
+        queue = self._queue = Queue.Queue(maxsize=2 * self.cursor_batch_size)
+        fetcher = threading.Thread(target=self._fetch_ops, args=(oplog, queue))
+        fetcher.daemon = True
+        fetcher.start()
 
+        while self.running:
             try:
-                logging.debug('Tailing over %r...' % query)
-                cursor = oplog.find(query, tailable=True)
-                # OplogReplay flag greatly improves scanning for ts performance.
-                cursor.add_option(pymongo.cursor._QUERY_OPTIONS['oplog_replay'])
+                op = queue.get(timeout=self.poll_time)
+            except Queue.Empty:
+                # No new oplog entries for poll_time seconds.
+                op = None
+
+            if isinstance(op, tuple):
+                # The fetcher died, raise its error (see _fetch_ops).
+                raise op[0], op[1], op[2]
 
-                while self.running:
-                    for op in cursor:
+            # Retry until the op is processed, so that none are skipped while
+            # e.g. the destination is unreachable.
+            while self.running:
+                try:
+                    if op is None:
+                        self.flush()
+                    else:
                         self.process_op(op['ns'], op)
-                    time.sleep(self.poll_time)
-                    if not cursor.alive:
-                        break
+                    break
+                except AutoReconnect, e:
+                    logging.warning(e)
+                except OperationFailure, e:
+                    logging.exception(e)
+
+                if op is not None and self.ts == op['ts']:
+                    # The op itself was processed, whatever failed after it
+                    # will be retried on the next flush.
+                    break
+                self._pause()
+
+        # Don't wait for the fetcher: it might be blocked in a getMore for a
+        # while, and exits on its own once that returns (see _put).
+        self.flush()
+
+    def _fetch_ops(self, oplog, queue):
+        """ Tails the oplog for entries newer than self.ts, and puts them
+        into queue (see start).
+        """
+        ts = self.ts
+        cursor = None
+        while self.running:
+            try:
+                # Keep tailing the same cursor for as long as it's alive, as
+                # re-querying has to scan the oplog for ts again.
+                if cursor is None:
+                    cursor = self._tail(oplog, ts)
+
+                for op in cursor:
+                    if not self._put(queue, op):
+                        return
+                    ts = op['ts']
+
+                if not cursor.alive:
+                    # E.g.: the oplog was empty. Re-query in a while.
+                    cursor = None
+                    self._pause()
             except AutoReconnect, e:
                 logging.warning(e)
-                time.sleep(self.poll_time)
+                cursor = None
+                self._pause()
             except OperationFailure, e:
                 logging.exception(e)
-                time.sleep(self.poll_time)
+                cursor = None
+                self._pause()
+            except Exception:
+                # Anything else can't be retried: hand it over to start(),
+                # instead of silently stopping fetching.
+                self._put(queue, sys.exc_info())
+                return
+
+    def _tail(self, oplog, ts):
+        """ Returns a tailable cursor over the oplog entries newer than ts. """
+        query = { 'ts': {'$gt': ts} }
+        logging.debug('Tailing over %r...' % query)
+
+        # With await_data, the server blocks for a while waiting for new
+        # oplog entries, instead of returning no data right away, so there's
+        # no need to sleep between getMores. OplogReplay flag greatly
+        # improves scanning for ts performance.
+        return oplog.find(query, cursor_type=CursorType.TAILABLE_AWAIT,
+                          oplog_replay=True,
+                          batch_size=self.cursor_batch_size)
+
+    def _put(self, queue, item):
+        """ Puts item into queue, waiting for a free slot unless stopped.
+
+        Returns False if the OplogWatcher was stopped in the meantime.
+        """
+        while self.running:
+            try:
+                queue.put(item, timeout=self.poll_time)
+                return True
+            except Queue.Full:
+                pass
+        return False
 
     def stop(self):
         self.running = False
+        self._stopped.set()
+        # Wake up start(), if it's waiting for new oplog entries.
+        if self._queue is not None:
+            try:
+                self._queue.put_nowait(None)
+            except Queue.Full:
+                pass
+
+    def _pause(self):
+        """ Waits for poll_time seconds, or until stopped. """
+        self._stopped.wait(self.poll_time)
 
     def process_op(self, ns, raw):
         """ Processes a single operation from the oplog.
@@ -89,29 +208,85 @@ class OplogWatcher(object):
             "db" declares presence of a database
             "n" no op
         """
-        # Compute the document id of the document that will be altered
-        # (in case of insert, update or delete).
-        docid = self.__get_id(raw)
+        if self.databases is not None and not self._watches(ns, raw):
+            self.ts = raw['ts']
+            return
+
+        self._dispatch(ns, raw)
 
+    def _dispatch(self, ns, raw):
+        """ Calls the handler of raw['op'], past the databases filter. """
         op = raw['op']
-        if op == 'i':
-            self.insert(ns=ns, docid=docid, raw=raw)
-        elif op == 'u':
-            self.update(ns=ns, docid=docid, raw=raw)
-        elif op == 'd':
-            self.delete(ns=ns, docid=docid, raw=raw)
-        elif op == 'c':
-            self.command(ns=ns, raw=raw)
-        elif op == 'db':
-            self.db_declare(ns=ns, raw=raw)
-        elif op == 'n':
-            self.noop()
+        handler = self._handlers.get(op)
+        if handler is not None:
+            handler(ns, raw)
         else:
             logging.error("Unknown op: %r" % op)
 
         # Save timestamp of last processed oplog.
         self.ts = raw['ts']
 
+    def _watches(self, ns, raw):
+        """ Determines if the op raw on ns should be processed, given
+        databases.
+
+        Checked before anything else in process_op, so ignored ops cost
+        next to nothing.
+        """
+        op = raw['op']
+        if op == 'n':
+            return True
+
+        if op == 'c' and ns == 'admin.$cmd':
+            # Admin commands name their namespaces in o, e.g.:
+            # {"renameCollection": "mydb.old", "to": "mydb.new"}. Process
+            # those which touch any of the databases.
+            o = raw['o']
+            return any(self._watches_ns(o[key])
+                       for key in ('renameCollection', 'to') if key in o)
+
+        return self._watches_ns(ns)
+
+    def _watches_ns(self, ns):
+        # Namespaces repeat a lot, only parse each of them once.
+        watched = self._watched_ns.get(ns)
+        if watched is None:
+            # Cheaper than ns.split('.', 1)[0] ("db" ops have no dot).
+            dot = ns.find('.')
+            dbname = ns[:dot] if dot >= 0 else ns
+            watched = self._watched_ns[ns] = dbname in self.databases
+        return watched
+
+    # Only insert, update and delete need to compute the id of the document
+    # that will be altered.
+
+    def _do_insert(self, ns, raw):
+        # Inserts and deletes have no o2, the _id can only be found in o.
+        self.insert(ns=ns, docid=raw['o'].get('_id'), raw=raw)
+
+    def _do_update(self, ns, raw):
+        self.update(ns=ns, docid=self.__get_id(raw), raw=raw)
+
+    def _do_delete(self, ns, raw):
+        self.delete(ns=ns, docid=raw['o'].get('_id'), raw=raw)
+
+    def _do_command(self, ns, raw):
+        self.command(ns=ns, raw=raw)
+
+    def _do_db_declare(self, ns, raw):
+        self.db_declare(ns=ns, raw=raw)
+
+    def _do_noop(self, ns, raw):
+        self.noop()
+
+    def flush(self):
+        """ Called whenever there were no new oplog entries to process
+        for poll_time seconds (and once more, when stopping).
+
+        Subclasses that buffer ops in process_op should write them out here.
+        """
+        pass
+
     def insert(self, ns, docid, raw, **kw):
         pass
 
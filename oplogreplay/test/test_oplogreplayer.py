@@ -1,6 +1,14 @@
-import unittest2 as unittest
+import sys
+# Python 2.7's unittest has everything used here, only 2.6 needs unittest2.
+if sys.version_info < (2, 7):
+    import unittest2 as unittest
+else:
+    import unittest
 
 import pymongo
+from bson.son import SON
+from pymongo.operations import InsertOne, UpdateOne, DeleteMany
+from pymongo.write_concern import WriteConcern
 import time
 import random
 import threading
@@ -10,124 +18,240 @@ from oplogreplay import OplogReplayer
 SOURCE_HOST = '127.0.0.1:27017'
 DEST_HOST = '127.0.0.1:27018'
 TESTDB = 'testdb'
+# Database left out of replay by test_databases.
+OTHERDB = 'otherdb'
+# Collections used by the tests, dropped before each of them.
+TEST_COLLECTIONS = ('testcoll', 'testidx', 'renamed')
+# Default poll_time of the tested OplogReplayer. Ops are only counted once
+# flushed, which happens after poll_time without new ops: keep it short.
+POLL_TIME = 0.01
 
 # Inherit from OplogReplayer to count number of processed_op methodcalls.
+# Ops are only counted once flushed, as inserts might still be buffered.
+# Waiters are notified through cond whenever count changes. unflushed is only
+# touched by the replaying thread, and count only while holding cond, so
+# neither needs any other synchronization.
 class CountingOplogReplayer(OplogReplayer):
 
-    count = 0
+    def __init__(self, *args, **kwargs):
+        self.count = 0
+        self.cond = threading.Condition()
+        self.unflushed = 0
+        # Timestamp of the last op added to unflushed.
+        self.counted_ts = None
+        # Timestamp of the last op known to be on destination, and in count.
+        self.flushed_ts = None
+        OplogReplayer.__init__(self, *args, **kwargs)
 
     def process_op(self, ns, raw):
+        if self.counted_ts is None:
+            # Everything up to here was replayed by some earlier run.
+            self.counted_ts = self.ts
+        # Commands are flushed within process_op, before being counted: the
+        # ts of such an op must only be published by a later flush.
         OplogReplayer.process_op(self, ns, raw)
-        CountingOplogReplayer.count += 1
+        self.unflushed += 1
+        self.counted_ts = raw['ts']
+
+    def flush(self):
+        OplogReplayer.flush(self)
+        with self.cond:
+            self.count += self.unflushed
+            if self.counted_ts is None:
+                self.flushed_ts = self.ts
+            else:
+                self.flushed_ts = self.counted_ts
+            self.cond.notify_all()
+        self.unflushed = 0
 
 class TestOplogReplayer(unittest.TestCase):
     """ TestCase for the OplogReplayer.
 
-    Each test performs the following (see setUp and tearDown for more details):
-      * delete test databases
-      * start an OplogReplayer
+    A single OplogReplayer is shared by all tests (see setUpClass). Each test
+    performs the following (see setUp for more details):
+      * drop test collections, and wait for the drops to be replayed
       * perform some actions (inserts, etc.)
       * wait for the OplogReplayer to finish replaying ops
       * assertions
-      * stop the OplogReplayer
     """
 
+    oplogreplayer = None
+    thread = None
+    # Arguments of the running OplogReplayer, if not the default ones.
+    replay_kwargs = None
+
     @classmethod
     def setUpClass(cls):
         # Create connections to both test databases.
-        cls.source = pymongo.Connection(SOURCE_HOST)
-        cls.dest = pymongo.Connection(DEST_HOST)
+        cls.source = pymongo.MongoClient(SOURCE_HOST)
+        cls.dest = pymongo.MongoClient(DEST_HOST)
+
+        # Start from empty test databases. dropDatabase is a command, so each
+        # of these only returns once the database is gone. Source and
+        # destination are different servers: drop on both at the same time.
+        def drop_source():
+            cls.source.drop_database(TESTDB)
+            cls.source.drop_database(OTHERDB)
+        source_drop = threading.Thread(target=drop_source)
+        source_drop.start()
+        cls.dest.drop_database(TESTDB)
+        cls.dest.drop_database(OTHERDB)
+        cls.dest.drop_database('oplogreplay')
+        source_drop.join()
+
+        cls._restart_replay()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._stop_replay()
 
-    def _start_replay(self, **kwargs):
+    @classmethod
+    def _restart_replay(cls, poll_time=POLL_TIME, **kwargs):
         # Stop the OplogReplayer before starting a new one.
-        self._stop_replay()
-        #if getattr(self, 'oplogreplayer', None):
-        #    self._stop_replay()
+        cls._stop_replay()
 
         # Init & start OplogReplayer, in a separate thread.
-        self.oplogreplayer = CountingOplogReplayer(
-            SOURCE_HOST, DEST_HOST, poll_time=0.1, **kwargs)
-        self.thread = threading.Thread(target=self.oplogreplayer.start)
-        self.thread.start()
+        cls.oplogreplayer = CountingOplogReplayer(
+            SOURCE_HOST, DEST_HOST, poll_time=poll_time, **kwargs)
+        if poll_time != POLL_TIME:
+            kwargs['poll_time'] = poll_time
+        cls.replay_kwargs = kwargs
+        cls.thread = threading.Thread(target=cls.oplogreplayer.start)
+        cls.thread.start()
 
-    def _stop_replay(self):
+    @classmethod
+    def _stop_replay(cls):
         # Stop OplogReplayer & join its thread.
-        if getattr(self, 'oplogreplayer', None):
-            self.oplogreplayer.stop()
-        if getattr(self, 'thread', None):
-            self.thread.join()
+        if cls.oplogreplayer is not None:
+            cls.oplogreplayer.stop()
+        if cls.thread is not None:
+            # Stopping takes at most a poll_time, plus a final flush.
+            cls.thread.join(timeout=1.0)
+            if cls.thread.is_alive():
+                raise Exception('OplogReplayer did not stop after 1.00sec')
         # Delete oplogreplayer & thread.
-        self.oplogreplayer = None
-        self.thread = None
+        cls.oplogreplayer = None
+        cls.thread = None
 
     def setUp(self):
-        # Drop test databases.
-        self.source.drop_database(TESTDB)
-        self.dest.drop_database(TESTDB)
-        self.dest.drop_database('oplogreplay')
-        # Sleep a little to allow drop database operations to complete.
-        time.sleep(0.05)
-
         # Remember Database objects.
         self.sourcedb = self.source.testdb
         self.destdb = self.dest.testdb
 
-        # Stop replay, in case it was still running from a previous test.
-        self._stop_replay()
-
-        # Reset global counter & start OplogReplayer.
-        CountingOplogReplayer.count = 0
-        self._start_replay()
+        # Go back to a default OplogReplayer, in case the previous test
+        # stopped it or started one with different arguments.
+        if self.oplogreplayer is None or self.replay_kwargs:
+            self._restart_replay()
+
+        # Drop test collections on source. Instead of dropping them on
+        # destination too, let the OplogReplayer replay the drops. Dropping
+        # a missing collection is a no-op, which doesn't hit the oplog.
+        for name in TEST_COLLECTIONS:
+            self.sourcedb.drop_collection(name)
+        self._wait_for_catchup()
+
+        # Reset the OplogReplayer's counter.
+        with self.oplogreplayer.cond:
+            self.oplogreplayer.count = 0
+
+    def _wait_for_catchup(self, timeout=3.0):
+        """ Synchronously wait for the OplogReplayer to replay every op
+        currently in the source oplog.
+        """
+        obj = self.source.local.oplog.rs.find().sort('$natural', -1).limit(1)[0]
+        lastts = obj['ts']
 
-    def tearDown(self):
-        self._stop_replay()
+        replayer = self.oplogreplayer
+        cond = replayer.cond
+        wait_until = time.time() + timeout
+        with cond:
+            # Later ops (e.g. periodic noops) might get flushed along, hence
+            # >= rather than ==.
+            while replayer.flushed_ts is None or replayer.flushed_ts < lastts:
+                remaining = wait_until - time.time()
+                if remaining <= 0:
+                    raise Exception('OplogReplayer did not catch up with %r '
+                                    'after a %.2fsec wait' % (lastts, timeout))
+                cond.wait(remaining)
 
     def _synchronous_wait(self, target, timeout=3.0):
         """ Synchronously wait for the oplogreplay to finish.
 
-        Waits until the oplog's retry_count hits target, but at most
-        timeout seconds.
+        Waits until the running OplogReplayer's count reaches target, but at
+        most timeout seconds. Overshooting target doesn't wait for the
+        timeout: tests that care about the exact count assert it afterwards.
         """
+        replayer = self.oplogreplayer
+        cond = replayer.cond
         wait_until = time.time() + timeout
-        while time.time() < wait_until:
-            if CountingOplogReplayer.count == target:
-                return
-            time.sleep(0.05)
-        # Synchronously waiting timed out - we should alert this.
-        raise Exception('retry_count was only %s/%s after a %.2fsec wait' % \
-                        (CountingOplogReplayer.count, target, timeout))
+        with cond:
+            while replayer.count < target:
+                remaining = wait_until - time.time()
+                if remaining <= 0:
+                    # Synchronously waiting timed out - we should alert this.
+                    raise Exception('retry_count was only %s/%s after a '
+                                    '%.2fsec wait' % \
+                                    (replayer.count, target, timeout))
+                cond.wait(remaining)
 
     def assertCollectionEqual(self, coll1, coll2):
-        self.assertEqual(coll1.count(), coll2.count(),
+        # Fetch both collections at once, instead of querying coll2 for each
+        # document of coll1.
+        objs1 = list(coll1.find())
+        objs2 = list(coll2.find())
+        self.assertEqual(len(objs1), len(objs2),
                          msg='Collections have different count.')
-        for obj1 in coll1.find():
-            obj2 = coll2.find_one(obj1)
+
+        # Only regular collections are compared (see assertDatabaseEqual), so
+        # every document has an _id.
+        objs2_by_id = {}
+        for obj in objs2:
+            try:
+                objs2_by_id[obj['_id']] = obj
+            except TypeError:
+                pass
+
+        for obj1 in objs1:
+            try:
+                obj2 = objs2_by_id.get(obj1['_id'])
+            except TypeError:
+                # E.g.: embedded document _ids.
+                obj2 = coll2.find_one({'_id': obj1['_id']})
             self.assertEqual(obj1, obj2)
 
     def assertDatabaseEqual(self, db1, db2):
-        self.assertListEqual(db1.collection_names(), db2.collection_names(),
+        # Indexes are checked by the index tests, skip system.indexes & co.
+        names1 = db1.collection_names(include_system_collections=False)
+        names2 = db2.collection_names(include_system_collections=False)
+        self.assertListEqual(sorted(names1), sorted(names2),
                              msg='Databases have different collections.')
-        for coll in db1.collection_names():
+        for coll in names1:
             self.assertCollectionEqual(db1[coll], db2[coll])
 
     def test_writes(self):
-        self.sourcedb.testcoll.insert({'content': 'mycontent', 'nr': 1})
-        self.sourcedb.testcoll.insert({'content': 'mycontent', 'nr': 2})
-        self.sourcedb.testcoll.insert({'content': 'mycontent', 'nr': 3})
-        self.sourcedb.testcoll.remove({'nr': 3})
-        self.sourcedb.testcoll.insert({'content': 'mycontent', 'nr': 4})
-
-        self.sourcedb.testcoll.insert({'content': 'mycontent', 'nr': 5})
-        self.sourcedb.testcoll.insert({'content': '...', 'nr': 6})
-        self.sourcedb.testcoll.update({'nr': 6}, {'$set': {'content': 'newContent'}})
-        self.sourcedb.testcoll.update({'nr': 97}, {'$set': {'content': 'newContent'}})
-        self.sourcedb.testcoll.update({'nr': 8}, {'$set': {'content': 'newContent'}}, upsert=True)
-
-        self.sourcedb.testcoll.remove({'nr': 99})
-        self.sourcedb.testcoll.remove({'nr': 3})
-        self.sourcedb.testcoll.remove({'nr': 4})
-        self.sourcedb.testcoll.insert({'content': 'new content', 'nr': 3})
-        self.sourcedb.testcoll.insert({'content': 'new content', 'nr': 4})
+        # Send all writes at once. The bulk write is ordered, as later writes
+        # depend on earlier ones, and each of them still hits the oplog on
+        # its own.
+        self.sourcedb.testcoll.bulk_write([
+            InsertOne({'content': 'mycontent', 'nr': 1}),
+            InsertOne({'content': 'mycontent', 'nr': 2}),
+            InsertOne({'content': 'mycontent', 'nr': 3}),
+            DeleteMany({'nr': 3}),
+            InsertOne({'content': 'mycontent', 'nr': 4}),
+
+            InsertOne({'content': 'mycontent', 'nr': 5}),
+            InsertOne({'content': '...', 'nr': 6}),
+            UpdateOne({'nr': 6}, {'$set': {'content': 'newContent'}}),
+            UpdateOne({'nr': 97}, {'$set': {'content': 'newContent'}}),
+            UpdateOne({'nr': 8}, {'$set': {'content': 'newContent'}},
+                      upsert=True),
+
+            DeleteMany({'nr': 99}),
+            DeleteMany({'nr': 3}),
+            DeleteMany({'nr': 4}),
+            InsertOne({'content': 'new content', 'nr': 3}),
+            InsertOne({'content': 'new content', 'nr': 4}),
+        ], ordered=True)
 
         # Removes and updates that don't do anything will not hit the oplog:
         self._synchronous_wait(12)
@@ -136,10 +260,17 @@ class TestOplogReplayer(unittest.TestCase):
         self.assertDatabaseEqual(self.sourcedb, self.destdb)
 
     def _perform_bulk_inserts(self, nr=100):
-        for i in xrange(nr):
-            obj = { 'content': '%s' % random.random(),
-                    'nr': random.randrange(100000) }
-            self.sourcedb.testcoll.insert(obj)
+        # Build all documents up front, so that the loop below only does I/O.
+        rand, randrange = random.random, random.randrange
+        objs = [{ 'content': repr(rand()), 'nr': randrange(100000) }
+                for i in xrange(nr)]
+        # Each document still gets its own oplog entry. insert_many splits
+        # the documents according to the server's limits. Writes are not
+        # acknowledged: tests wait for them to be replayed anyway (see
+        # _synchronous_wait).
+        testcoll = self.sourcedb.testcoll.with_options(
+            write_concern=WriteConcern(w=0))
+        testcoll.insert_many(objs, ordered=False)
 
     def test_bulk_inserts(self):
         self._perform_bulk_inserts(1000)
@@ -149,24 +280,76 @@ class TestOplogReplayer(unittest.TestCase):
         # Test that the 2 test databases are identical.
         self.assertDatabaseEqual(self.sourcedb, self.destdb)
 
+    def test_parallel_replay(self):
+        # Replay with 2 workers, over 2 namespaces.
+        self._restart_replay(workers=2)
+
+        self._perform_bulk_inserts(500)
+        # Make sure all documents are there before updating them.
+        self._synchronous_wait(500)
+        self.sourcedb.testcoll.update_many({}, {'$set': {'updated': True}})
+        self.sourcedb.testidx.insert_many([{'nr': i} for i in xrange(100)])
+        self.sourcedb.testidx.delete_many({'nr': {'$lt': 50}})
+
+        self._synchronous_wait(1150)
+
+        # Test that the 2 test databases are identical.
+        self.assertDatabaseEqual(self.sourcedb, self.destdb)
+
+    def test_databases(self):
+        self._restart_replay(databases=[TESTDB])
+
+        # Replayed, as they're on TESTDB.
+        self.sourcedb.testcoll.insert_one({'content': 'mycontent', 'nr': 1})
+        self.sourcedb.testcoll.insert_one({'content': 'mycontent', 'nr': 2})
+        # Not replayed.
+        self.source[OTHERDB].testcoll.insert_one({'content': 'other'})
+        # Admin command, replayed as it renames a collection on TESTDB.
+        self.source.admin.command(SON([
+            ('renameCollection', '%s.testcoll' % TESTDB),
+            ('to', '%s.renamed' % TESTDB)]))
+
+        self._synchronous_wait(4)
+
+        # Test that the 2 test databases are identical.
+        self.assertDatabaseEqual(self.sourcedb, self.destdb)
+        self.assertEqual(self.destdb.renamed.count(), 2)
+        self.assertNotIn(OTHERDB, self.dest.database_names())
+
+    def test_unhashable_ids(self):
+        # Embedded document _ids can't be tracked within an insert batch,
+        # they must be replayed all the same, along with buffered inserts.
+        self.sourcedb.testcoll.insert_many(
+            [{'_id': 1}] + [{'_id': {'nr': i}} for i in xrange(10)] +
+            [{'_id': 2}])
+        self.sourcedb.testcoll.update_one({'_id': {'nr': 3}},
+                                          {'$set': {'content': 'updated'}})
+
+        self._synchronous_wait(13)
+
+        # Test that the 2 test databases are identical.
+        self.assertDatabaseEqual(self.sourcedb, self.destdb)
+
     def test_discontinued_replay(self):
         self._perform_bulk_inserts(200)
+        # Each OplogReplayer counts its own ops: keep the stopped one around.
+        stopped = self.oplogreplayer
         self._stop_replay()
         self._perform_bulk_inserts(150)
-        self._start_replay()
+        self._restart_replay()
         self._perform_bulk_inserts(100)
 
-        self._synchronous_wait(450)
+        self._synchronous_wait(450 - stopped.count)
 
         # Test that the 2 test databases are identical.
         self.assertDatabaseEqual(self.sourcedb, self.destdb)
 
         # Test that no operation was replayed twice.
-        self.assertEqual(CountingOplogReplayer.count, 450)
+        self.assertEqual(stopped.count + self.oplogreplayer.count, 450)
 
     def test_index_operations(self):
         # Create an index, then test that it was created on destionation.
-        index = self.sourcedb.testidx.ensure_index('idxfield')
+        index = self.sourcedb.testidx.create_index('idxfield')
         self._synchronous_wait(1)
         self.assertIn(index, self.destdb.testidx.index_information())
 
@@ -177,17 +360,19 @@ class TestOplogReplayer(unittest.TestCase):
 
     def test_replay_indexes(self):
         # Create index1 on source + dest.
-        index1 = self.sourcedb.testidx.ensure_index('idxfield1')
+        index1 = self.sourcedb.testidx.create_index('idxfield1')
+        self._synchronous_wait(1)
 
-        # Restart OplogReplayer, without replaying indexes.
-        self._start_replay(replay_indexes=False)
+        # Restart OplogReplayer, without replaying indexes. It resumes right
+        # after index1, and counts from 0.
+        self._restart_replay(replay_indexes=False)
 
         # Create index2 on source only.
-        index2 = self.sourcedb.testidx.ensure_index('idxfield2')
+        index2 = self.sourcedb.testidx.create_index('idxfield2')
         # Delete index1 from source only.
         self.sourcedb.testidx.drop_index(index1)
 
-        self._synchronous_wait(3)
+        self._synchronous_wait(2)
 
         # Test indexes on source and destination.
         source_indexes = self.sourcedb.testidx.index_information()
@@ -202,16 +387,16 @@ class TestOplogReplayer(unittest.TestCase):
         self._stop_replay()
 
         # Should not be replayed:
-        self.sourcedb.testcoll.insert({'content': 'mycontent', 'nr': 1})
+        self.sourcedb.testcoll.insert_one({'content': 'mycontent', 'nr': 1})
 
         # Get last timestamp.
         obj = self.source.local.oplog.rs.find().sort('$natural', -1).limit(1)[0]
         lastts = obj['ts']
 
         # Should be replayed.
-        self.sourcedb.testcoll.insert({'content': 'mycontent', 'nr': 1})
+        self.sourcedb.testcoll.insert_one({'content': 'mycontent', 'nr': 1})
 
-        self._start_replay(ts=lastts)
+        self._restart_replay(ts=lastts)
 
         self._synchronous_wait(1)
 
@@ -1,17 +1,18 @@
-from distutils.core import setup
+from setuptools import setup
 
 setup(
     name='OplogReplay',
     version='0.1.4',
     author='Mihnea Giurgea',
     author_email='GiurgeaMihnea@gmail.com',
-    packages=['oplogreplay', 'oplogreplay.test'],
+    packages=['oplogreplay'],
     scripts=['bin/oplogreplay'],
     url='http://pypi.python.org/pypi/OplogReplay/',
     license='LICENSE.txt',
     description='MongoDB oplog replay utility.',
     long_description=open('README.txt').read(),
     install_requires=[
-        "pymongo == 2.1.1"
+        "pymongo >= 3.0, < 4"
     ],
+    test_suite='oplogreplay.test',
 )
\ No newline at end of file